@@ -6,43 +6,155 @@ https://github.com/cpmpercussion/keras-mdn-layer
 Hat tip to [Omimo's Keras MDN layer](https://github.com/omimo/Keras-MDN)
 for a starting point for this code.
 
+Mixed precision: create_mdn_layers accepts a Keras dtype policy such as
+'mixed_bfloat16' for its Dense layer (or follows the global policy set with
+tf.keras.mixed_precision.set_global_policy). The mixture parameters it outputs,
+and the values used by the loss, sampling and MSE functions, are always
+float32, since the log-probabilities need the extra range.
+
 Provided under MIT License
 """
 from .version import __version__
 
+import functools
+
 import numpy as np
 
 import tensorflow as tf
 from tensorflow_probability import distributions as tfd
 
+LOG_2_PI = np.log(2.0 * np.pi)
+EPSILON = tf.keras.backend.epsilon()
+EPS_PLUS_ONE = 1.0 + EPSILON
+
+# Random generator used by the Numpy sampling functions, see seed_mdn.
+_rng = np.random.default_rng()
+
+
+def seed_mdn(seed=None):
+    """Reseed the random generator used by the Numpy sampling functions
+    (sample_from_categorical, sample_from_output, sample_from_output_batch).
+
+    Keyword arguments:
+    seed -- seed for np.random.default_rng, or None for fresh entropy (default None)
+    """
+    global _rng
+    _rng = np.random.default_rng(seed)
+
 
+@tf.keras.utils.register_keras_serializable(package='mdn')
 def elu_plus_one_plus_epsilon(x):
     """ELU activation with a very small addition to help prevent
     NaN in loss."""
-    return tf.keras.backend.elu(x) + 1 + tf.keras.backend.epsilon()
-
-
-def create_mdn_layers(input_layer, output_dim, num_mixes, mu_activation=None):
-    mdn_mus = tf.keras.layers.Dense(
-        output_dim * num_mixes,
-        activation=mu_activation)(input_layer)  # optional activation for means
-    mdn_sigmas = tf.keras.layers.Dense(
-        output_dim * num_mixes,
-        activation=elu_plus_one_plus_epsilon)(input_layer)
-    # softmax is applied to pi when sampling, so no need for activation here
-    mdn_pi = tf.keras.layers.Dense(num_mixes)(input_layer)
-    return tf.keras.layers.concatenate([mdn_mus, mdn_sigmas, mdn_pi])
+    return tf.nn.elu(x) + EPS_PLUS_ONE
+
+
+@tf.keras.utils.register_keras_serializable(package='mdn')
+def softplus_sigma(x):
+    """Softplus activation with a very small addition, an alternative to
+    elu_plus_one_plus_epsilon with smoother gradients near zero."""
+    return tf.nn.softplus(x) + EPSILON
+
+
+@tf.keras.utils.register_keras_serializable(package='mdn')
+class MDNActivations(tf.keras.layers.Layer):
+    """Splits the output of the fused MDN Dense layer into mus, sigmas and pi
+    logits, applies the mu and sigma activations, and joins them again.
+    The sigma activation defaults to elu_plus_one_plus_epsilon. Always computes in float32 so sigma keeps its epsilon under mixed precision."""
+
+    def __init__(self, output_dim, num_mixes, mu_activation=None, sigma_activation=None, **kwargs):
+        kwargs['dtype'] = 'float32'
+        super(MDNActivations, self).__init__(**kwargs)
+        self.output_dim = output_dim
+        self.num_mixes = num_mixes
+        self.mu_activation = tf.keras.activations.get(mu_activation)
+        if sigma_activation is None:
+            sigma_activation = elu_plus_one_plus_epsilon
+        self.sigma_activation = tf.keras.activations.get(sigma_activation)
+
+    def call(self, params):
+        mus, sigmas, pi = tf.split(
+            tf.cast(params, tf.float32),
+            num_or_size_splits=[
+                self.num_mixes * self.output_dim,
+                self.num_mixes * self.output_dim,
+                self.num_mixes
+            ],
+            axis=-1
+        )
+        mus = self.mu_activation(mus)  # optional activation for means
+        sigmas = self.sigma_activation(sigmas)  # must keep sigmas positive
+        # softmax is applied to pi when sampling, so no need for activation here
+        return tf.concat([mus, sigmas, pi], axis=-1)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = super(MDNActivations, self).get_config()
+        config.update({
+            'output_dim': self.output_dim,
+            'num_mixes': self.num_mixes,
+            'mu_activation': tf.keras.activations.serialize(self.mu_activation),
+            'sigma_activation': tf.keras.activations.serialize(self.sigma_activation)
+        })
+        config.pop('dtype', None)  # always float32, set in __init__
+        return config
+
+
+def create_mdn_layers(input_layer, output_dim, num_mixes, mu_activation=None, dtype=None, sigma_activation=None):
+    # A single Dense layer produces all of the mixture parameters at once,
+    # the activations are then applied to the mu and sigma slices.
+    # sigma_activation defaults to elu_plus_one_plus_epsilon, or softplus_sigma.
+    # dtype can be a mixed precision policy, e.g. 'mixed_bfloat16'.
+    mdn_params = tf.keras.layers.Dense(
+        (2 * num_mixes * output_dim) + num_mixes,
+        dtype=dtype)(input_layer)
+    return MDNActivations(
+        output_dim, num_mixes,
+        mu_activation=mu_activation,
+        sigma_activation=sigma_activation)(mdn_params)
+
+
+def _make_mixture(out_mu, out_sigma, out_pi, component_shape):
+    """Construct the mixture model for split MDN parameters, batched over
+    the components. Only called while tracing the tf.function helpers below,
+    so the distribution objects are built once per trace rather than per step."""
+    return tfd.MixtureSameFamily(
+        mixture_distribution=tfd.Categorical(logits=out_pi),
+        components_distribution=tfd.MultivariateNormalDiag(
+            loc=tf.reshape(out_mu, component_shape),
+            scale_diag=tf.reshape(out_sigma, component_shape)
+        )
+    )
 
 
 def get_mixture_loss_func(output_dim, num_mixes):
     """Construct a loss functions for the MDN layer parametrised by number of mixtures."""
+    # normalise the arguments so positional and keyword calls share a cache entry
+    return _get_mixture_loss_func(int(output_dim), int(num_mixes))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_mixture_loss_func(output_dim, num_mixes):
+    # Static split sizes and component shape, shared by every call and trace
+    param_splits = [num_mixes * output_dim, num_mixes * output_dim, num_mixes]
+    component_shape = [-1, num_mixes, output_dim]
+
     # Construct a loss function with the right number of mixtures and outputs
-    def loss_func(y_true, y_pred):
+    @tf.function(jit_compile=True, reduce_retracing=True)
+    def traced_loss_func(y_true, y_pred):
+        # Compute in float32 in case the model uses mixed precision
+        y_pred = tf.cast(y_pred, tf.float32)
         # Reshape inputs in case this is used in a TimeDistribued layer
-        y_pred = tf.reshape(
-            y_pred,
-            [-1, (2 * num_mixes * output_dim) + num_mixes]
-        )
+        if y_pred.shape.rank != 2:
+            y_pred = tf.reshape(
+                y_pred,
+                [-1, (2 * num_mixes * output_dim) + num_mixes]
+            )
+        y_true = tf.cast(y_true, tf.float32)
+        # always flatten targets, (batch, time) targets with output_dim 1
+        # are rank 2 but still need to line up with the flattened y_pred
         y_true = tf.reshape(
             y_true,
             [-1, output_dim]
@@ -50,26 +162,28 @@ def get_mixture_loss_func(output_dim, num_mixes):
         # Split the inputs into paramaters
         out_mu, out_sigma, out_pi = tf.split(
             y_pred,
-            num_or_size_splits=[
-                num_mixes * output_dim,
-                num_mixes * output_dim,
-                num_mixes
-            ],
+            num_or_size_splits=param_splits,
+            axis=-1
+        )
+        # Mixture log-likelihood of a diagonal normal mixture, written out
+        # directly so that it compiles to a single fused computation.
+        mus = tf.reshape(out_mu, component_shape)
+        sigs = tf.reshape(out_sigma, component_shape)
+        log_pi = tf.nn.log_softmax(out_pi, axis=-1)
+        z = (tf.expand_dims(y_true, 1) - mus) / sigs
+        log_components = -0.5 * tf.reduce_sum(
+            tf.square(z) + LOG_2_PI + 2.0 * tf.math.log(sigs),
             axis=-1
         )
-        # Construct the mixture models
-        cat = tfd.Categorical(logits=out_pi)
-        component_splits = [output_dim] * num_mixes
-        mus = tf.split(out_mu, num_or_size_splits=component_splits, axis=1)
-        sigs = tf.split(out_sigma, num_or_size_splits=component_splits, axis=1)
-        coll = [tfd.MultivariateNormalDiag(loc=loc, scale_diag=scale) for loc, scale
-                in zip(mus, sigs)]
-        mixture = tfd.Mixture(cat=cat, components=coll)
-        loss = mixture.log_prob(y_true)
+        loss = tf.reduce_logsumexp(log_pi + log_components, axis=-1)
         loss = tf.negative(loss)
         loss = tf.reduce_mean(loss)
         return loss
 
+    # Plain function wrapper so Keras saves the loss by name ('loss_func')
+    def loss_func(y_true, y_pred):
+        return traced_loss_func(y_true, y_pred)
+
     # Actually return the loss_func
     return loss_func
 
@@ -78,35 +192,40 @@ def get_mixture_sampling_fun(output_dim, num_mixes):
     """Construct a TensorFlor sampling operation for the MDN layer parametrised
     by mixtures and output dimension. This can be used in a Keras model to
     generate samples directly."""
+    # normalise the arguments so positional and keyword calls share a cache entry
+    return _get_mixture_sampling_fun(int(output_dim), int(num_mixes))
 
-    def sampling_func(y_pred):
+
+@functools.lru_cache(maxsize=None)
+def _get_mixture_sampling_fun(output_dim, num_mixes):
+    # Static split sizes and component shape, shared by every call and trace
+    param_splits = [num_mixes * output_dim, num_mixes * output_dim, num_mixes]
+    component_shape = [-1, num_mixes, output_dim]
+
+    @tf.function(jit_compile=True, reduce_retracing=True)
+    def traced_sampling_func(y_pred):
+        # Compute in float32 in case the model uses mixed precision
+        y_pred = tf.cast(y_pred, tf.float32)
         # Reshape inputs in case this is used in a TimeDistribued layer
-        y_pred = tf.reshape(
-            y_pred,
-            [-1, (2 * num_mixes * output_dim) + num_mixes]
-        )
+        if y_pred.shape.rank != 2:
+            y_pred = tf.reshape(
+                y_pred,
+                [-1, (2 * num_mixes * output_dim) + num_mixes]
+            )
         out_mu, out_sigma, out_pi = tf.split(
             y_pred,
-            num_or_size_splits=[
-                num_mixes * output_dim,
-                num_mixes * output_dim,
-                num_mixes
-            ],
+            num_or_size_splits=param_splits,
             axis=1
         )
-        cat = tfd.Categorical(logits=out_pi)
-        component_splits = [output_dim] * num_mixes
-        mus = tf.split(out_mu, num_or_size_splits=component_splits, axis=1)
-        sigs = tf.split(out_sigma, num_or_size_splits=component_splits, axis=1)
-        coll = [
-            tfd.MultivariateNormalDiag(loc=loc, scale_diag=scale)
-            for loc, scale in zip(mus, sigs)
-        ]
-        mixture = tfd.Mixture(cat=cat, components=coll)
+        mixture = _make_mixture(out_mu, out_sigma, out_pi, component_shape)
         samp = mixture.sample()
         # Todo: temperature adjustment for sampling function.
         return samp
 
+    # Plain function wrapper so Keras saves the function by name
+    def sampling_func(y_pred):
+        return traced_sampling_func(y_pred)
+
     # Actually return the loss_func
     return sampling_func
 
@@ -114,40 +233,49 @@ def get_mixture_sampling_fun(output_dim, num_mixes):
 def get_mixture_mse_accuracy(output_dim, num_mixes):
     """Construct an MSE accuracy function for the MDN layer
     that takes one sample and compares to the true value."""
+    # normalise the arguments so positional and keyword calls share a cache entry
+    return _get_mixture_mse_accuracy(int(output_dim), int(num_mixes))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_mixture_mse_accuracy(output_dim, num_mixes):
+    # Static split sizes and component shape, shared by every call and trace
+    param_splits = [num_mixes * output_dim, num_mixes * output_dim, num_mixes]
+    component_shape = [-1, num_mixes, output_dim]
+
     # Construct a loss function with the right number of mixtures and outputs
-    def mse_func(y_true, y_pred):
+    @tf.function(jit_compile=True, reduce_retracing=True)
+    def traced_mse_func(y_true, y_pred):
+        # Compute in float32 in case the model uses mixed precision
+        y_pred = tf.cast(y_pred, tf.float32)
         # Reshape inputs in case this is used in a TimeDistribued layer
-        y_pred = tf.reshape(
-            y_pred,
-            [-1, (2 * num_mixes * output_dim) + num_mixes]
-        )
+        if y_pred.shape.rank != 2:
+            y_pred = tf.reshape(
+                y_pred,
+                [-1, (2 * num_mixes * output_dim) + num_mixes]
+            )
+        y_true = tf.cast(y_true, tf.float32)
+        # always flatten targets, (batch, time) targets with output_dim 1
+        # are rank 2 but still need to line up with the flattened y_pred
         y_true = tf.reshape(
             y_true,
             [-1, output_dim]
         )
         out_mu, out_sigma, out_pi = tf.split(
             y_pred,
-            num_or_size_splits=[
-                num_mixes * output_dim,
-                num_mixes * output_dim,
-                num_mixes
-            ],
+            num_or_size_splits=param_splits,
             axis=1
         )
-        cat = tfd.Categorical(logits=out_pi)
-        component_splits = [output_dim] * num_mixes
-        mus = tf.split(out_mu, num_or_size_splits=component_splits, axis=1)
-        sigs = tf.split(out_sigma, num_or_size_splits=component_splits, axis=1)
-        coll = [
-            tfd.MultivariateNormalDiag(loc=loc, scale_diag=scale)
-            for loc, scale in zip(mus, sigs)
-        ]
-        mixture = tfd.Mixture(cat=cat, components=coll)
+        mixture = _make_mixture(out_mu, out_sigma, out_pi, component_shape)
         samp = mixture.sample()
         mse = tf.reduce_mean(tf.square(samp - y_true), axis=-1)
         # Todo: temperature adjustment for sampling functon.
         return mse
 
+    # Plain function wrapper so Keras saves the metric by name ('mse_func')
+    def mse_func(y_true, y_pred):
+        return traced_mse_func(y_true, y_pred)
+
     # Actually return the loss_func
     return mse_func
 
@@ -167,7 +295,7 @@ def split_mixture_params(params, output_dim, num_mixes):
     return mus, sigs, pi_logits
 
 
-def softmax(w, t=1.0):
+def softmax(w, t=1.0, axis=-1):
     """Softmax function for a list or numpy array of logits. Also adjusts temperature.
 
     Arguments:
@@ -175,31 +303,30 @@ def softmax(w, t=1.0):
 
     Keyword arguments:
     t -- the temperature for to adjust the distribution (default 1.0)
+    axis -- the axis of the logits to normalise over (default -1)
     """
-    e = np.array(w) / t  # adjust temperature
-    e -= e.max()  # subtract max to protect from exploding exp values.
-    e = np.exp(e)
-    dist = e / np.sum(e)
-    return dist
+    e = np.asarray(w, dtype=np.float64) * (1.0 / t)  # adjust temperature (new array, w is untouched)
+    e -= e.max(axis=axis, keepdims=True)  # subtract max to protect from exploding exp values.
+    np.exp(e, out=e)
+    e /= e.sum(axis=axis, keepdims=True)
+    return e
 
 
 def sample_from_categorical(dist):
     """Samples from a categorical model PDF.
 
     Arguments:
-    dist -- the parameters of the categorical model
+    dist -- the parameters of the categorical model, a list or numpy array
 
     Returns:
-    One sample from the categorical model, or -1 if sampling fails.
+    One sample from the categorical model.
     """
-    r = np.random.rand(1)  # uniform random number in [0,1]
-    accumulate = 0
-    for i in range(0, dist.size):
-        accumulate += dist[i]
-        if accumulate >= r:
-            return i
-    tf.logging.info('Error sampling categorical model.')
-    return -1
+    dist = np.asarray(dist)
+    cdf = np.cumsum(dist)
+    r = _rng.random()  # uniform random number in [0,1]
+    idx = int(np.searchsorted(cdf, r))
+    # guard against rounding leaving the final cdf value just below r.
+    return min(idx, dist.size - 1)
 
 
 def sample_from_output(params, output_dim, num_mixes, temp=1.0, sigma_temp=1.0):
@@ -219,13 +346,90 @@ def sample_from_output(params, output_dim, num_mixes, temp=1.0, sigma_temp=1.0):
     Returns:
     One sample from the the mixture model.
     """
-    mus, sigs, pi_logits = split_mixture_params(params, output_dim, num_mixes)
-    pis = softmax(pi_logits, t=temp)
+    params = np.asarray(params)
+    pis = softmax(params[-num_mixes:], t=temp)
     m = sample_from_categorical(pis)
     # Alternative way to sample from categorical:
-    # m = np.random.choice(range(len(pis)), p=pis)
-    mus_vector = mus[m * output_dim:(m + 1) * output_dim]
-    sig_vector = sigs[m * output_dim:(m + 1) * output_dim] * sigma_temp  # adjust for temperature
-    cov_matrix = np.identity(output_dim) * sig_vector
-    sample = np.random.multivariate_normal(mus_vector, cov_matrix, 1)
-    return sample
+    # m = _rng.choice(len(pis), p=pis)
+    # Index the chosen component's mu and sigma directly out of params.
+    mu_start = m * output_dim
+    sig_start = (num_mixes + m) * output_dim
+    mus_vector = params[mu_start:mu_start + output_dim]
+    sig_vector = params[sig_start:sig_start + output_dim] * sigma_temp  # adjust for temperature
+    # diagonal covariance, so each dimension is an independent normal draw.
+    sample = mus_vector + sig_vector * _rng.standard_normal(output_dim)
+    return sample.reshape(1, output_dim)
+
+
+def sample_from_output_batch(params, output_dim, num_mixes, temp=1.0, sigma_temp=1.0):
+    """Sample from a batch of MDN outputs with temperature adjustment.
+    Equivalent to calling sample_from_output on each row of params, but
+    done for the whole batch at once using Numpy.
+
+    Arguments:
+    params -- a (batch, parameters) array of mixture model parameters, a
+              single parameter vector is treated as a batch of one
+    output_dim -- the dimension of the normal models in the mixture model
+    num_mixes -- the number of mixtures represented
+
+    Keyword arguments:
+    temp -- the temperature for sampling between mixture components (default 1.0)
+    sigma_temp -- the temperature for sampling from the normal distribution (default 1.0)
+
+    Returns:
+    A (batch, output_dim) array with one sample for each row of params.
+    """
+    params = np.atleast_2d(params)
+    batch_size = params.shape[0]
+    mus = params[:, :num_mixes * output_dim].reshape(batch_size, num_mixes, output_dim)
+    sigs = params[:, num_mixes * output_dim:2 * num_mixes * output_dim].reshape(batch_size, num_mixes, output_dim)
+    pis = softmax(params[:, -num_mixes:], t=temp, axis=1)
+    # inverse cdf sample of one mixture component per row.
+    cdf = pis.cumsum(axis=1)
+    m = (cdf < _rng.random((batch_size, 1))).sum(axis=1)
+    m = np.minimum(m, num_mixes - 1)
+    rows = np.arange(batch_size)
+    mus_vector = mus[rows, m]
+    sig_vector = sigs[rows, m] * sigma_temp  # adjust for temperature
+    return mus_vector + sig_vector * _rng.standard_normal((batch_size, output_dim))
+
+
+def sample_from_output_tf(params, output_dim, num_mixes, temp=1.0, sigma_temp=1.0):
+    """Sample from an MDN output with temperature adjustment.
+    This calculation is done in TensorFlow, so it can stay on the device
+    with the model (e.g. inside a generation loop) rather than converting
+    the model output to Numpy.
+
+    Arguments:
+    params -- the parameters of the mixture model, one vector or a batch of them
+    output_dim -- the dimension of the normal models in the mixture model
+    num_mixes -- the number of mixtures represented
+
+    Keyword arguments:
+    temp -- the temperature for sampling between mixture components (default 1.0)
+    sigma_temp -- the temperature for sampling from the normal distribution (default 1.0)
+
+    Returns:
+    A (batch, output_dim) tensor of samples from the mixture model.
+    """
+    params = tf.convert_to_tensor(params)
+    if not params.dtype.is_floating:
+        params = tf.cast(params, tf.float32)
+    # temperatures as tensors, so changing them does not retrace the sampler
+    temp = tf.convert_to_tensor(temp, dtype=params.dtype)
+    sigma_temp = tf.convert_to_tensor(sigma_temp, dtype=params.dtype)
+    return _sample_from_output_tf(params, temp, sigma_temp, int(output_dim), int(num_mixes))
+
+
+@tf.function(reduce_retracing=True)
+def _sample_from_output_tf(params, temp, sigma_temp, output_dim, num_mixes):
+    """Traced body of sample_from_output_tf, retraced only for new
+    output_dim and num_mixes values (or params dtypes)."""
+    params = tf.reshape(params, [-1, (2 * num_mixes * output_dim) + num_mixes])
+    mus = tf.reshape(params[:, :num_mixes * output_dim], [-1, num_mixes, output_dim])
+    sigs = tf.reshape(params[:, num_mixes * output_dim:2 * num_mixes * output_dim], [-1, num_mixes, output_dim])
+    pi_logits = params[:, -num_mixes:] / temp  # adjust temperature
+    m = tf.random.categorical(pi_logits, num_samples=1)[:, 0]
+    mus_vector = tf.gather(mus, m, batch_dims=1)
+    sig_vector = tf.gather(sigs, m, batch_dims=1) * sigma_temp  # adjust for temperature
+    return mus_vector + sig_vector * tf.random.normal(tf.shape(mus_vector), dtype=mus_vector.dtype)
@@ -1,4 +1,7 @@
 import keras
+import numpy as np
+import tensorflow as tf
+from tensorflow_probability import distributions as tfd
 import mdn
 
 
@@ -11,3 +14,196 @@ def test_build_mdn():
     model.add(mdn.MDN(1, N_MIXES))
     model.compile(loss=mdn.get_mixture_loss_func(1, N_MIXES), optimizer=keras.optimizers.Adam())
     assert isinstance(model, keras.engine.sequential.Sequential)
+
+
+def test_sample_from_categorical(monkeypatch):
+    dist = [0.2, 0.3, 0.5]
+    mdn.seed_mdn(2018)
+    samples = [mdn.sample_from_categorical(dist) for _ in range(10000)]
+    np.testing.assert_allclose(np.bincount(samples, minlength=3) / 10000.0, dist, atol=0.02)
+
+    # rounding can leave the last cdf value just below the uniform draw
+    class NearlyOne(object):
+        def random(self):
+            return 1.0 - 1e-12
+    monkeypatch.setattr(mdn, '_rng', NearlyOne())
+    assert mdn.sample_from_categorical(np.array([0.5, 0.5 - 1e-9])) == 1
+
+
+def separated_mixture_params(output_dim, num_mixes, n_samples, sigma=1.0, dtype=np.float64):
+    """A batch of identical MDN parameters whose component means are 10 apart,
+    so each sample shows which component it was drawn from."""
+    pi_logits = np.arange(num_mixes, dtype=dtype)
+    mus = np.repeat(np.arange(num_mixes) * 10.0, output_dim)
+    sigs = np.full(num_mixes * output_dim, sigma)
+    params = np.tile(np.concatenate([mus, sigs, pi_logits]), (n_samples, 1)).astype(dtype)
+    return params, pi_logits
+
+
+def check_component_frequencies(samples, pi_logits):
+    """Asserts that samples from separated_mixture_params pick components with
+    frequencies matching softmax(pi_logits), and returns the offsets of each
+    sample from its component mean."""
+    num_mixes = len(pi_logits)
+    components = np.rint(samples[:, 0] / 10.0).astype(int)
+    frequencies = np.bincount(components, minlength=num_mixes) / float(len(samples))
+    np.testing.assert_allclose(frequencies, mdn.softmax(pi_logits), atol=0.02)
+    return samples - components[:, None] * 10.0
+
+
+def test_sample_from_output():
+    OUTPUT_DIMS = 2
+    N_MIXES = 3
+    SIGMA = 0.8
+    SIGMA_TEMP = 0.5
+    params, pi_logits = separated_mixture_params(OUTPUT_DIMS, N_MIXES, 10000, sigma=SIGMA)
+    mdn.seed_mdn(2018)
+    samples = np.vstack([mdn.sample_from_output(p, OUTPUT_DIMS, N_MIXES, temp=1.0, sigma_temp=SIGMA_TEMP) for p in params])
+    assert samples.shape == (10000, OUTPUT_DIMS)
+    # sigma is the standard deviation of each component, scaled by sigma_temp
+    offsets = check_component_frequencies(samples, pi_logits)
+    np.testing.assert_allclose(offsets.std(axis=0), SIGMA * SIGMA_TEMP, rtol=0.05)
+
+
+def test_seed_mdn_reproduces_samples():
+    OUTPUT_DIMS = 2
+    N_MIXES = 3
+    params, _ = separated_mixture_params(OUTPUT_DIMS, N_MIXES, 50)
+    mdn.seed_mdn(2345)
+    first = (mdn.sample_from_output(params[0], OUTPUT_DIMS, N_MIXES), mdn.sample_from_output_batch(params, OUTPUT_DIMS, N_MIXES))
+    mdn.seed_mdn(2345)
+    second = (mdn.sample_from_output(params[0], OUTPUT_DIMS, N_MIXES), mdn.sample_from_output_batch(params, OUTPUT_DIMS, N_MIXES))
+    np.testing.assert_array_equal(first[0], second[0])
+    np.testing.assert_array_equal(first[1], second[1])
+
+
+def test_sample_from_output_batch():
+    OUTPUT_DIMS = 2
+    N_MIXES = 3
+    params, pi_logits = separated_mixture_params(OUTPUT_DIMS, N_MIXES, 20000)
+    mdn.seed_mdn(2018)
+    # a tiny sigma_temp should pull the samples onto the component means
+    samples = mdn.sample_from_output_batch(params, OUTPUT_DIMS, N_MIXES, temp=1.0, sigma_temp=1e-3)
+    assert samples.shape == (20000, OUTPUT_DIMS)
+    np.testing.assert_allclose(check_component_frequencies(samples, pi_logits), 0.0, atol=0.1)
+    # a single parameter vector is sampled as a batch of one
+    assert mdn.sample_from_output_batch(params[0], OUTPUT_DIMS, N_MIXES).shape == (1, OUTPUT_DIMS)
+
+
+def test_time_distributed_targets():
+    # rank 3 predictions with rank 2 targets, e.g. (batch, time) for output_dim 1
+    OUTPUT_DIMS = 1
+    N_MIXES = 3
+    y_pred = np.random.rand(4, 5, 2 * N_MIXES * OUTPUT_DIMS + N_MIXES).astype(np.float32) + 0.1
+    y_true = np.random.rand(4, 5).astype(np.float32)
+    loss = mdn.get_mixture_loss_func(OUTPUT_DIMS, N_MIXES)(y_true, y_pred)
+    mse = mdn.get_mixture_mse_accuracy(OUTPUT_DIMS, N_MIXES)(y_true, y_pred)
+    assert loss.shape == ()
+    assert mse.shape == (20,)
+
+
+def test_save_load_mdn_layers(tmp_path):
+    OUTPUT_DIMS = 2
+    N_MIXES = 3
+    inputs = tf.keras.Input(shape=(4,))
+    outputs = mdn.create_mdn_layers(inputs, OUTPUT_DIMS, N_MIXES, mu_activation='tanh')
+    model = tf.keras.Model(inputs, outputs)
+    model.compile(loss=mdn.get_mixture_loss_func(OUTPUT_DIMS, N_MIXES), optimizer='adam')
+    x = np.random.rand(3, 4).astype(np.float32)
+    path = str(tmp_path / 'mdn_model.keras')
+    model.save(path)
+    loaded = tf.keras.models.load_model(path, custom_objects={'loss_func': mdn.get_mixture_loss_func(OUTPUT_DIMS, N_MIXES)})
+    np.testing.assert_allclose(model.predict(x, verbose=0), loaded.predict(x, verbose=0), rtol=1e-6)
+
+
+def test_softplus_sigma_activation(tmp_path):
+    OUTPUT_DIMS = 2
+    N_MIXES = 3
+    inputs = tf.keras.Input(shape=(4,))
+    outputs = mdn.create_mdn_layers(inputs, OUTPUT_DIMS, N_MIXES, sigma_activation=mdn.softplus_sigma)
+    model = tf.keras.Model(inputs, outputs)
+    x = np.random.rand(3, 4).astype(np.float32)
+    dense = model.layers[1]
+    params = dense(x).numpy()
+    sigmas = slice(N_MIXES * OUTPUT_DIMS, 2 * N_MIXES * OUTPUT_DIMS)
+    np.testing.assert_allclose(model.predict(x, verbose=0)[:, sigmas], mdn.softplus_sigma(params[:, sigmas]), rtol=1e-5)
+    path = str(tmp_path / 'mdn_softplus.keras')
+    model.save(path)
+    loaded = tf.keras.models.load_model(path)
+    assert loaded.layers[2].sigma_activation is mdn.softplus_sigma
+    np.testing.assert_allclose(model.predict(x, verbose=0), loaded.predict(x, verbose=0), rtol=1e-6)
+
+
+def test_mixed_precision_mdn_layers():
+    OUTPUT_DIMS = 2
+    N_MIXES = 3
+    inputs = tf.keras.Input(shape=(4,))
+    outputs = mdn.create_mdn_layers(inputs, OUTPUT_DIMS, N_MIXES, dtype='mixed_bfloat16')
+    model = tf.keras.Model(inputs, outputs)
+    dense, activations = model.layers[1], model.layers[2]
+    assert dense.compute_dtype == 'bfloat16'
+    x = np.random.rand(8, 4).astype(np.float32)
+    y_pred = model(x)
+    assert y_pred.dtype == tf.float32
+    loss = mdn.get_mixture_loss_func(OUTPUT_DIMS, N_MIXES)(np.random.rand(8, OUTPUT_DIMS), y_pred)
+    assert np.isfinite(loss.numpy())
+    # the activations stay float32 after a config round trip, even though dtype is not stored
+    config = activations.get_config()
+    restored = mdn.MDNActivations.from_config(config)
+    assert restored.get_config() == config
+    assert restored.compute_dtype == 'float32'
+    np.testing.assert_allclose(restored(dense(x)), y_pred, rtol=1e-6)
+
+
+def test_loss_matches_tfp_mixture():
+    OUTPUT_DIMS = 2
+    N_MIXES = 3
+    BATCH = 8
+    mus = np.random.randn(BATCH, N_MIXES * OUTPUT_DIMS).astype(np.float32)
+    sigs = np.random.rand(BATCH, N_MIXES * OUTPUT_DIMS).astype(np.float32) + 0.1
+    pi_logits = np.random.randn(BATCH, N_MIXES).astype(np.float32)
+    y_pred = np.concatenate([mus, sigs, pi_logits], axis=1)
+    y_true = np.random.randn(BATCH, OUTPUT_DIMS).astype(np.float32)
+    mixture = tfd.MixtureSameFamily(
+        mixture_distribution=tfd.Categorical(logits=pi_logits),
+        components_distribution=tfd.MultivariateNormalDiag(
+            loc=mus.reshape(BATCH, N_MIXES, OUTPUT_DIMS),
+            scale_diag=sigs.reshape(BATCH, N_MIXES, OUTPUT_DIMS)
+        )
+    )
+    expected = -tf.reduce_mean(mixture.log_prob(y_true))
+    loss_func = mdn.get_mixture_loss_func(OUTPUT_DIMS, N_MIXES)
+    np.testing.assert_allclose(loss_func(y_true, y_pred), expected, rtol=1e-5)
+    # rank 3 inputs, as from a TimeDistributed layer
+    np.testing.assert_allclose(loss_func(y_true.reshape(2, 4, OUTPUT_DIMS), y_pred.reshape(2, 4, -1)), expected, rtol=1e-5)
+
+
+def test_sample_from_output_tf():
+    OUTPUT_DIMS = 2
+    N_MIXES = 3
+    params, pi_logits = separated_mixture_params(OUTPUT_DIMS, N_MIXES, 20000, dtype=np.float32)
+    tf.random.set_seed(2018)
+    samples = mdn.sample_from_output_tf(params, OUTPUT_DIMS, N_MIXES, temp=1.0, sigma_temp=1e-3)
+    assert samples.shape == (20000, OUTPUT_DIMS)
+    assert samples.dtype == tf.float32
+    np.testing.assert_allclose(check_component_frequencies(samples.numpy(), pi_logits), 0.0, atol=0.1)
+    # a single parameter vector gives a batch of one, new temperatures do not retrace
+    traces = mdn._sample_from_output_tf.experimental_get_tracing_count()
+    for temp in [0.5, 0.8, 1.2, 1.5]:
+        assert mdn.sample_from_output_tf(params[0], OUTPUT_DIMS, N_MIXES, temp=temp, sigma_temp=temp).shape == (1, OUTPUT_DIMS)
+    assert mdn._sample_from_output_tf.experimental_get_tracing_count() == traces + 1
+    # integer parameters are sampled as float32, like the Numpy samplers accept them
+    int_samples = mdn.sample_from_output_tf(np.array([0, 1, 1, 1, 0, 0]), 1, 2, sigma_temp=0.5)
+    assert int_samples.shape == (1, 1)
+    assert int_samples.dtype == tf.float32
+
+
+def test_helper_functions_are_cached():
+    OUTPUT_DIMS = 2
+    N_MIXES = 3
+    for get_func in [mdn.get_mixture_loss_func, mdn.get_mixture_sampling_fun, mdn.get_mixture_mse_accuracy]:
+        func = get_func(OUTPUT_DIMS, N_MIXES)
+        assert get_func(OUTPUT_DIMS, N_MIXES) is func
+        assert get_func(output_dim=OUTPUT_DIMS, num_mixes=N_MIXES) is func
+        assert get_func(OUTPUT_DIMS, num_mixes=N_MIXES) is func
+        assert get_func(OUTPUT_DIMS, N_MIXES + 1) is not func